@@ -20,7 +20,7 @@ URL = 'https://github.com/AlgoWit/sports-betting'
 LICENSE = 'MIT'
 DOWNLOAD_URL = 'https://github.com/AlgoWit/sports-betting'
 VERSION = __version__
-INSTALL_REQUIRES = ['scipy>=0.17', 'numpy>=1.1', 'pandas==0.24.2', 'scikit-learn>=0.21', 'imbalanced-learn>=0.4.3', 'joblib==0.13.2', 'tqdm==4.28.1']
+INSTALL_REQUIRES = ['scipy>=0.17', 'numpy>=1.1', 'pandas==0.24.2', 'scikit-learn>=0.21', 'imbalanced-learn>=0.4.3', 'joblib==0.13.2', 'threadpoolctl>=1.0', 'tqdm==4.28.1']
 CLASSIFIERS = ['Intended Audience :: Science/Research',
                'Intended Audience :: Developers',
                'License :: OSI Approved',
@@ -40,5 +40,6 @@ CONFIG = {
     'random_state': 0,
     'n_runs': 3,
     'n_jobs': -1,
+    'backend': 'loky',
     'excluded_features': ['season', 'date', 'league', 'team1', 'team2']
 }
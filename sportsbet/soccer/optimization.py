@@ -7,22 +7,28 @@ betting strategy on historical and current data.
 # License: BSD 3 clause
 
 from argparse import ArgumentParser
+from contextlib import ExitStack
 from ast import literal_eval
 from itertools import product
 from os.path import join
 from sqlite3 import connect
 from abc import abstractmethod
 from importlib import import_module
-from joblib import delayed, Parallel
+from joblib import delayed, Parallel, parallel_backend, effective_n_jobs
 
 import numpy as np
 import pandas as pd
 from sklearn.base import BaseEstimator, clone, is_classifier
+from sklearn.dummy import DummyClassifier
 from sklearn.model_selection import ParameterGrid
 from sklearn.utils import check_random_state, check_X_y, check_array
-from sklearn.preprocessing import MultiLabelBinarizer
 from sklearn.model_selection import train_test_split
+from threadpoolctl import threadpool_limits
 from tqdm import tqdm
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
 from sportsbet import SOCCER_PATH
 from sportsbet.externals import TimeSeriesSplit
@@ -30,53 +36,126 @@ from sportsbet.soccer import TARGETS
 from sportsbet.soccer.config import CONFIG
 
 DB_CONNECTION = connect(join(SOCCER_PATH, 'soccer.db'))
+LABELS = np.array(['-'] + sorted(TARGETS))  # Sorted since '-' precedes all targets
+LABEL_CODES = {label: code for code, label in enumerate(LABELS)}
+DETERMINISTIC_STRATEGIES = ('most_frequent', 'prior', 'constant')
+_VALID_TARGETS = frozenset(TARGETS)
+PROCESS_BACKENDS = ('loky', 'multiprocessing')
 
 
 def extract_multi_labels(score1, score2, targets):
     """Extract multi-labels matrix for multi-output classification."""
     
     # Check input data
-    score1 = check_array(score1, dtype=int, ensure_2d=False)
-    score2 = check_array(score2, dtype=int, ensure_2d=False)
-    targets = check_array(targets, dtype=object, ensure_2d=False)
+    score1 = check_array(score1, dtype=None, ensure_2d=False).astype(np.int16)
+    score2 = check_array(score2, dtype=None, ensure_2d=False).astype(np.int16)
 
     # Generate multi-labels
-    multi_labels = np.column_stack([TARGETS[target](score1, score2) for target in targets]).astype(int)
+    multi_labels = np.column_stack([TARGETS[target](score1, score2) for target in targets]).astype(np.int8)
     
     return multi_labels
 
 
-def extract_class_labels(score1, score2, odds, targets):
-    """Extract class labels for multi-class classification."""
+def encode_labels(labels):
+    """Encode class labels to integer codes, unknown labels are encoded as no bets."""
+    labels = np.asarray(labels, dtype=str)
+    codes = np.searchsorted(LABELS, labels).clip(max=len(LABELS) - 1)
+    return np.where(LABELS[codes] == labels, codes, LABEL_CODES['-']).astype(np.int8)
+
+
+def extract_class_codes(score1, score2, odds, targets, multi_labels=None):
+    """Extract class labels codes for multi-class classification."""
     
     # Check input data
-    odds = check_array(odds)
+    odds = check_odds(odds)
 
-    # Generate class labels
-    multi_labels = extract_multi_labels(score1, score2, targets)
-    indices = (multi_labels * odds).argmax(axis=1)
-    class_labels = np.array([targets[ind] for ind in indices])
-    class_labels[multi_labels.sum(axis=1) == 0] = '-'
+    # Extract multi-labels
+    if multi_labels is None:
+        multi_labels = extract_multi_labels(score1, score2, targets)
+
+    # Generate class labels codes
+    winning_odds = multi_labels * odds
+    class_codes = encode_labels(targets)[winning_odds.argmax(axis=1)]
+    class_codes[winning_odds.max(axis=1) == 0.0] = LABEL_CODES['-']
     
-    return class_labels
+    return class_codes
+
+
+def extract_class_labels(score1, score2, odds, targets, multi_labels=None):
+    """Extract class labels for multi-class classification."""
+    return LABELS[extract_class_codes(score1, score2, odds, targets, multi_labels)]
+
+
+def _calculate_yields_numpy(multi_labels, cols, odds, mask):
+    """Calculate the yields of the selected odds columns."""
+    cols = cols[:, None]
+    won = np.take_along_axis(multi_labels, cols, axis=1)[:, 0].astype(np.float64)
+    picked_odds = np.take_along_axis(odds, cols, axis=1)[:, 0]
+    return mask.astype(np.float64) * (won * (picked_odds - 1.0) + (won - 1.0))
+
+
+if njit is not None:
+
+    @njit(cache=True, fastmath=True)
+    def _calculate_yields_numba(multi_labels, cols, odds, mask):
+        """Calculate the yields of the selected odds columns in a single loop."""
+        yields = np.empty(cols.size)
+        for ind in range(cols.size):
+            won = multi_labels[ind, cols[ind]]
+            yields[ind] = mask[ind] * (won * (odds[ind, cols[ind]] - 1.0) + (won - 1.0))
+        return yields
 
+    _calculate_yields = _calculate_yields_numba
 
-def calculate_yields(score1, score2, bets, odds, targets):
+else:
+    _calculate_yields = _calculate_yields_numpy
+
+
+def calculate_yields(score1, score2, bets, odds, targets, multi_labels=None):
     """Calculate the yields."""
 
+    # Extract multi-labels
+    if multi_labels is None:
+        multi_labels = extract_multi_labels(score1, score2, targets)
+
     # Check odds
-    odds = check_array(odds)
-    targets = check_array(targets, dtype=object, ensure_2d=False)
+    odds = np.asarray(odds, dtype=np.float64)
+
+    # Map bets codes to odds columns
+    codes_to_cols = np.full(len(LABELS), -1, dtype=np.intp)
+    codes_to_cols[encode_labels(targets)] = np.arange(len(targets))
+    cols = codes_to_cols[encode_labels(bets)]
+    mask = cols != -1
+    cols = np.where(mask, cols, 0)
 
     # Generate yields
-    bets = MultiLabelBinarizer(classes=['-'] + targets.tolist()).fit_transform([[bet] for bet in bets])[:, 1:]
-    yields = ((extract_multi_labels(score1, score2, targets) * odds - 1.0) * bets).sum(axis=1)
+    yields = _calculate_yields(np.asarray(multi_labels), cols, odds, mask)
 
     return yields
 
 
+if njit is not None:
+
+    @njit(cache=True, fastmath=True)
+    def _extract_yields_stats(yields):
+        """Extract coverage, mean and std of yields in a single pass."""
+        n_yields, n_bets, sum_yields, sum_squared_yields = yields.size, 0, 0.0, 0.0
+        for value in yields:
+            if value != 0.0:
+                n_bets += 1
+                sum_yields += value
+                sum_squared_yields += value * value
+        if n_bets == 0:
+            return (0.0 if n_yields > 0 else np.nan), np.nan, np.nan
+        mean_yield = sum_yields / n_bets
+        var_yield = sum_squared_yields / n_bets - mean_yield * mean_yield
+        return n_bets / n_yields, mean_yield, np.sqrt(max(var_yield, 0.0))
+
+
 def extract_yields_stats(yields):
     """Extract coverage, mean and std of yields."""
+    if njit is not None:
+        return _extract_yields_stats(np.ascontiguousarray(yields, dtype=np.float64))
     coverage_mask = (yields != 0.0)
     return coverage_mask.mean(), yields[coverage_mask].mean(), yields[coverage_mask].std()
     
@@ -87,59 +166,132 @@ def check_random_states(random_state, repetitions):
     return [random_state.randint(0, 2 ** 32 - 1, dtype='uint32') for _ in range(repetitions)]
 
 
-def fit_bet(bettor, params, risk_factors, random_state, X, scores, odds, train_indices, test_indices):
+def check_X(X):
+    """Check input data as a contiguous float array."""
+    return check_array(X, dtype=np.float64, order='C', force_all_finite=False)
+
+
+def check_odds(odds):
+    """Check odds as a contiguous float array."""
+    return check_array(odds, dtype=np.float64, order='C')
+
+
+def check_targets(targets):
+    """Check targets of bettor."""
+    if targets is None:
+        return np.array(list(TARGETS.keys()))
+    if not _VALID_TARGETS.issuperset(targets):
+        raise ValueError(f'Targets should be any of {", ".join(TARGETS.keys())}')
+    return np.asarray(targets)
+
+
+def is_deterministic(bettor):
+    """Check whether the bettor predictions do not depend on its random states."""
+    params = bettor.get_params()
+    for param_name in params:
+        if 'random_state' in param_name:
+            estimator = params.get(param_name.rpartition('__')[0], bettor)
+            if not (isinstance(estimator, DummyClassifier) and estimator.strategy in DETERMINISTIC_STRATEGIES):
+                return False
+    return True
+
+
+def fit_bet(bettor, params, risk_factors, random_state, X, scores, odds, train_indices, test_indices, multi_labels=None, limit_threads=False):
     """Parallel fit and bet"""
 
     # Unpack scores
     avg_score1, avg_score2, score1, score2 = scores
 
-    # Set random state
-    for param_name in bettor.get_params():
-        if 'random_state' in param_name:
-            bettor.set_params(**{param_name: random_state})
+    # Clone bettor and set random state and parameters
+    random_state_params = {param_name: random_state for param_name in bettor.get_params() if 'random_state' in param_name}
+    bettor = clone(bettor).set_params(**{**random_state_params, **params})
 
-    # Fit better
-    bettor.set_params(**params).fit(X[train_indices], avg_score1[train_indices], avg_score2[train_indices], odds[train_indices])
+    with ExitStack() as stack:
 
-    # Generate data
-    data = []
-    for risk_factor in risk_factors:
-        bets = bettor.bet(X[test_indices], risk_factor)
-        yields = calculate_yields(score1[test_indices], score2[test_indices], bets, odds[test_indices], bettor.targets_)
-        data.append((str(params), random_state, risk_factor, yields))
+        # Limit BLAS threads of worker processes during the task to avoid oversubscription
+        if limit_threads:
+            stack.enter_context(threadpool_limits(limits=1, user_api='blas'))
+
+        # Fit better
+        bettor.fit(X[train_indices], avg_score1[train_indices], avg_score2[train_indices], odds[train_indices])
+
+        # Extract test data
+        X_test, score1_test, score2_test, odds_test = X[test_indices], score1[test_indices], score2[test_indices], odds[test_indices]
+        if multi_labels is None:
+            multi_labels_test = extract_multi_labels(score1_test, score2_test, bettor.targets_)
+        else:
+            multi_labels_test = multi_labels[test_indices]
+
+        # Generate data
+        data, parameters = [], str(params)
+        for risk_factor, bets in zip(risk_factors, bettor._bet_risk_factors(X_test, risk_factors)):
+            yields = calculate_yields(score1_test, score2_test, bets, odds_test, bettor.targets_, multi_labels_test)
+            data.append((parameters, random_state, risk_factor, yields))
     data = pd.DataFrame(data, columns=['parameters', 'experiment', 'risk_factor', 'yields'])
     
     return data
 
 
-def apply_backtesting(bettor, param_grid, risk_factors, X, scores, odds, cv, random_state, n_runs, n_jobs):
+def apply_backtesting(bettor, param_grid, risk_factors, X, scores, odds, cv, random_state, n_runs, n_jobs, backend='loky'):
     """Apply backtesting to evaluate bettor."""
     
     # Check random states
     random_states = check_random_states(random_state, n_runs)
 
     # Check arrays
-    X = check_array(X, dtype=None, force_all_finite=False)
+    X = check_X(X)
     normalized_scores = []
     for score in scores:
-        normalized_scores.append(check_array(score, dtype=None, ensure_2d=False))
-    odds = check_array(odds, dtype=None)
+        normalized_scores.append(check_array(score, dtype=None, ensure_2d=False, order='C'))
+    odds = check_odds(odds)
 
-    # Extract parameters
-    parameters = ParameterGrid(param_grid)
+    # Extract multi-labels
+    multi_labels = extract_multi_labels(*normalized_scores[2:], check_targets(bettor.targets))
 
-    # Run backtesting
-    data = Parallel(n_jobs=n_jobs)(delayed(fit_bet)(bettor, params, risk_factors, random_state, X, normalized_scores, odds, train_indices, test_indices) 
-           for params, random_state, (train_indices, test_indices) in tqdm(list(product(parameters, random_states, cv.split(X))), desc='Tasks'))
+    # Extract parameters, bettor template and splits
+    parameters = ParameterGrid(param_grid)
+    bettor = clone(bettor)
+    splits = [(np.ascontiguousarray(train_indices), np.ascontiguousarray(test_indices)) for train_indices, test_indices in cv.split(X)]
+
+    # Generate tasks, deterministic bettors are run only for the first random state
+    deterministic = np.array([is_deterministic(clone(bettor).set_params(**params)) for params in parameters], dtype=bool)
+    tasks = [(params_ind, run_ind, split_ind) for params_ind, run_ind, split_ind in product(range(len(parameters)), range(n_runs), range(len(splits)))
+             if run_ind == 0 or not deterministic[params_ind]]
+
+    with ExitStack() as stack:
+
+        # Start dask client, closed when backtesting is completed
+        if backend == 'dask':
+            from dask.distributed import Client, get_client
+            try:
+                get_client()
+            except ValueError:
+                stack.enter_context(Client())
+
+        # Run backtesting, each task fits once and bets for all risk factors and large arrays are memory mapped
+        with parallel_backend(backend):
+            limit_threads = backend in PROCESS_BACKENDS and effective_n_jobs(n_jobs) != 1
+            data = Parallel(n_jobs=n_jobs, batch_size='auto', pre_dispatch='2*n_jobs', max_nbytes='1M', mmap_mode='r')(
+                delayed(fit_bet)(bettor, parameters[params_ind], risk_factors, random_states[run_ind], X, normalized_scores, odds, *splits[split_ind], multi_labels, limit_threads) 
+                for params_ind, run_ind, split_ind in tqdm(tasks, desc='Tasks'))
+    
+    # Combine yields of test folds
+    offsets = np.cumsum([0] + [len(test_indices) for _, test_indices in splits])
+    yields = np.empty((len(parameters), n_runs, len(risk_factors), offsets[-1]))
+    for (params_ind, run_ind, split_ind), fold_data in zip(tasks, data):
+        yields[params_ind, run_ind, :, offsets[split_ind]:offsets[split_ind + 1]] = np.vstack(fold_data['yields'].values)
+    yields[deterministic, 1:] = yields[deterministic, :1]
     
-    # Combine data
-    data = pd.concat(data, ignore_index=True)
-    data = data.groupby(['parameters', 'risk_factor', 'experiment']).apply(lambda df: np.concatenate(df.yields.values)).reset_index()
-    data[['coverage', 'mean_yield', 'std_yield']] = pd.DataFrame(data[0].apply(lambda yields: extract_yields_stats(yields)).values.tolist())
+    # Extract yields statistics
+    data = pd.DataFrame([
+        (params_ind, risk_factor, random_state, *extract_yields_stats(yields[params_ind, run_ind, risk_factor_ind]))
+        for params_ind, (run_ind, random_state), (risk_factor_ind, risk_factor) in product(range(len(parameters)), enumerate(random_states), enumerate(risk_factors))
+    ], columns=['parameters', 'risk_factor', 'experiment', 'coverage', 'mean_yield', 'std_yield'])
     
     # Calculate results
-    results = data.drop(columns=['experiment', 0]).groupby(['parameters', 'risk_factor']).mean().reset_index()
+    results = data.drop(columns='experiment').groupby(['parameters', 'risk_factor']).mean().reset_index()
     results['std_mean_yield'] = data.groupby(['parameters', 'risk_factor'])['mean_yield'].std().values
+    results['parameters'] = [str(parameters[params_ind]) for params_ind in results['parameters']]
     results = results.sort_values('mean_yield', ascending=False).reset_index(drop=True)
 
     return results
@@ -167,30 +319,33 @@ class BettorMixin:
         """Fit base bettor."""
         
         # Check targets
-        if self.targets is None:
-            self.targets_ = np.array(list(TARGETS.keys()))
-        else:
-            if not set(self.targets).issubset(TARGETS.keys()):
-                raise ValueError(f'Targets should be any of {", ".join(self.targets)}')
-            else:
-                self.targets_ = check_array(self.targets, dtype=None, ensure_2d=False)
+        self.targets_ = check_targets(self.targets)
         
         return self
     
-    def bet(self, X, risk_factor):
-        """Generate bets."""
+    def _bet_risk_factors(self, X, risk_factors):
+        """Generate bets for multiple risk factors from a single prediction."""
 
-        # Check risk factor
-        if not isinstance(risk_factor, float) or risk_factor > 1.0 or risk_factor < 0.0:
-            raise ValueError('Risk factor should be a float in the [0.0, 1.0] interval.')
+        # Check risk factors
+        for risk_factor in risk_factors:
+            if not isinstance(risk_factor, float) or risk_factor > 1.0 or risk_factor < 0.0:
+                raise ValueError('Risk factor should be a float in the [0.0, 1.0] interval.')
         
-        # Generate bets
-        bets = self.predict(X)
+        # Generate predictions
+        predictions, max_probabilities = self.predict(X), self.predict_proba(X).max(axis=1)
 
         # Apply no bets
-        bets[self.predict_proba(X).max(axis=1) <= risk_factor] = '-'
+        bets_list = []
+        for risk_factor in risk_factors:
+            bets = predictions.copy()
+            bets[max_probabilities <= risk_factor] = '-'
+            bets_list.append(bets)
 
-        return bets
+        return bets_list
+
+    def bet(self, X, risk_factor):
+        """Generate bets."""
+        return self._bet_risk_factors(X, [risk_factor])[0]
 
 
 class Bettor(BaseEstimator, BettorMixin):
@@ -205,6 +360,9 @@ class Bettor(BaseEstimator, BettorMixin):
 
         super(Bettor, self).fit()
 
+        # Check odds
+        odds = check_odds(odds)
+
         # Extract targets
         y = extract_class_labels(score1, score2, odds, self.targets_)
 
@@ -237,19 +395,25 @@ class MultiBettor(BaseEstimator, BettorMixin):
 
         super(MultiBettor, self).fit()
 
+        # Check odds
+        odds = check_odds(odds)
+
+        # Extract multi-labels
+        multi_labels = extract_multi_labels(score1, score2, self.targets_)
+
         # Split data
-        X_multi, X_meta, score1_multi, score1_meta, score2_multi, score2_meta, _, odds_meta = train_test_split(
-            X, score1, score2, odds, 
+        X_multi, X_meta, Y_multi, Y_meta, _, odds_meta = train_test_split(
+            X, multi_labels, odds, 
             test_size=self.test_size, 
             random_state=self.random_state
         )
         
         # Extract targets
-        Y_multi = extract_multi_labels(score1_multi, score2_multi, self.targets_)
-        y_meta = extract_class_labels(score1_meta, score2_meta, odds_meta, self.targets_)
+        y_meta = extract_class_labels(None, None, odds_meta, self.targets_, Y_meta)
 
-        # Fit multi-classifier
-        self.multi_classifier_ = clone(self.multi_classifier).fit(X_multi, Y_multi)
+        # Fit multi-classifier, parallel fits of independent targets share data in threads
+        with parallel_backend('threading'):
+            self.multi_classifier_ = clone(self.multi_classifier).fit(X_multi, Y_multi)
 
         # Fit meta-classifier
         X_meta = np.column_stack([probs[:, 0] for probs in self.multi_classifier_.predict_proba(X_meta)])
@@ -321,7 +485,7 @@ def backtest():
     X, scores, odds = load_X(), load_scores(), load_odds(bettor)
 
     # Backtesting
-    results = apply_backtesting(bettor, CONFIG['param_grid'], CONFIG['risk_factors'], X, scores, odds, cv, CONFIG['random_state'], CONFIG['n_runs'], CONFIG['n_jobs'])
+    results = apply_backtesting(bettor, CONFIG['param_grid'], CONFIG['risk_factors'], X, scores, odds, cv, CONFIG['random_state'], CONFIG['n_runs'], CONFIG['n_jobs'], CONFIG['backend'])
     
     # Save backtesting results
     results.to_sql('backtesting_results', DB_CONNECTION, index=False, if_exists='replace')
@@ -5,17 +5,23 @@ Test the optimization module.
 import numpy as np
 import pandas as pd
 from sklearn.dummy import DummyClassifier
-from sklearn.model_selection import ParameterGrid
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import ParameterGrid, train_test_split
 from sklearn.multioutput import MultiOutputClassifier
 import pytest
+from threadpoolctl import threadpool_info, threadpool_limits
 
 from sportsbet.externals import TimeSeriesSplit
 from sportsbet.soccer import TARGETS
 from sportsbet.soccer.optimization import (
         extract_multi_labels, 
+        encode_labels,
+        extract_class_codes,
         extract_class_labels,
         calculate_yields,
+        _calculate_yields_numpy,
         extract_yields_stats,
+        is_deterministic,
         fit_bet,
         apply_backtesting,
         BettorMixin,
@@ -36,6 +42,28 @@ def test_extract_multi_labels():
     np.testing.assert_array_equal(extract_multi_labels(score1, score2, targets), multi_labels)
 
 
+def test_encode_labels():
+    """Test the encoding of class labels."""
+    labels = ['-', 'over_2.5', 'D', 'Away']
+    np.testing.assert_array_equal(encode_labels(labels), np.array([0, 7, 3, 0]))
+
+
+def test_extract_multi_labels_missing_scores():
+    """Test the extraction of multi-labels with missing scores."""
+    with pytest.raises(ValueError):
+        extract_multi_labels(pd.Series([1.0, np.nan]), pd.Series([0.0, 1.0]), ['H'])
+
+
+def test_extract_class_codes():
+    """Test the extraction of class labels codes."""
+    score1, score2 = [0, 2, 3], [1, 1, 3]
+    odds = [[3.0, 1.5, 2.0], [4.0, 2.0, 3.0], [2.5, 2.5, 2.0]]
+    targets = ['D', 'H', 'over_2.5']
+    class_codes = extract_class_codes(score1, score2, odds, targets)
+    assert class_codes.dtype == np.int8
+    np.testing.assert_array_equal(class_codes, encode_labels(['-', 'over_2.5', 'D']))
+
+
 def test_extract_class_labels():
     """Test the extraction of class labels."""
     score1, score2 = [0, 2, 3], [1, 1, 3]
@@ -45,6 +73,15 @@ def test_extract_class_labels():
     np.testing.assert_array_equal(extract_class_labels(score1, score2, odds, targets), class_labels)
 
 
+def test_extract_class_labels_multi_labels():
+    """Test the extraction of class labels with precomputed multi-labels."""
+    score1, score2 = [0, 2, 3], [1, 1, 3]
+    odds = [[3.0, 1.5, 2.0], [4.0, 2.0, 3.0], [2.5, 2.5, 2.0]]
+    targets = ['D', 'H', 'over_2.5']
+    multi_labels = extract_multi_labels(score1, score2, targets)
+    np.testing.assert_array_equal(extract_class_labels(None, None, odds, targets, multi_labels), np.array(['-', 'over_2.5', 'D']))
+
+
 def test_calculate_yields():
     """Test the calculation of yields."""
     score1, score2 = [0, 2, 3], [1, 1, 3]
@@ -55,12 +92,45 @@ def test_calculate_yields():
     np.testing.assert_array_equal(calculate_yields(score1, score2, bets, odds, targets), yields)
 
 
+def test_calculate_yields_multi_labels():
+    """Test the calculation of yields with precomputed multi-labels."""
+    score1, score2 = [0, 2, 3], [1, 1, 3]
+    bets = ['-', 'D', 'over_2.5']
+    odds = [[3.0, 1.5, 2.0], [4.0, 2.0, 3.0], [2.5, 2.5, 2.5]]
+    targets = ['D', 'H', 'over_2.5']
+    multi_labels = extract_multi_labels(score1, score2, targets)
+    np.testing.assert_array_equal(calculate_yields(score1, score2, bets, odds, targets, multi_labels), calculate_yields(score1, score2, bets, odds, targets))
+
+
+def test_calculate_yields_numba():
+    """Test that the numba yields kernel matches the numpy implementation."""
+    pytest.importorskip('numba')
+    from sportsbet.soccer.optimization import _calculate_yields_numba
+    random_state = np.random.RandomState(0)
+    multi_labels = random_state.randint(0, 2, (100, 3)).astype(np.int8)
+    cols = random_state.randint(0, 3, 100).astype(np.intp)
+    odds = random_state.uniform(1.0, 5.0, (100, 3))
+    mask = random_state.randint(0, 2, 100).astype(bool)
+    np.testing.assert_allclose(_calculate_yields_numba(multi_labels, cols, odds, mask), _calculate_yields_numpy(multi_labels, cols, odds, mask))
+
+
 def test_extract_yields_stats():
     """Test the calculation of yields."""
     yields = np.array([0.0, -1.0, 2.0, 0.0])
     np.testing.assert_array_equal(extract_yields_stats(yields), (0.5, 0.5, 1.5))
 
 
+@pytest.mark.parametrize('bettor, deterministic', [
+    (Bettor(classifier=DummyClassifier(strategy='constant', constant='H')), True),
+    (Bettor(classifier=DummyClassifier(strategy='prior')), True),
+    (Bettor(classifier=DummyClassifier(strategy='stratified')), False),
+    (MultiBettor(multi_classifier=MultiOutputClassifier(DummyClassifier(strategy='prior')), meta_classifier=DummyClassifier(strategy='prior')), False)
+])
+def test_is_deterministic(bettor, deterministic):
+    """Test the detection of deterministic bettors."""
+    assert is_deterministic(bettor) is deterministic
+
+
 def test_fit_bet():
     """Test fit and bet function."""
 
@@ -106,6 +176,84 @@ def test_apply_backtesting():
     assert len(results) == len(risk_factors) * len(ParameterGrid(param_grid))
 
 
+def test_apply_backtesting_results():
+    """Test backtesting results values."""
+
+    # Input data, home team wins one every three matches
+    bettor = Bettor(classifier=DummyClassifier(strategy='constant'), targets=['D', 'H'])
+    param_grid = {'classifier__constant': ['H', '-']}
+    risk_factors = [0.0, 1.0]
+    X = np.zeros((100, 2))
+    home_wins = np.arange(100) % 3 == 0
+    scores = home_wins.astype(int), (~home_wins).astype(int), home_wins.astype(int), (~home_wins).astype(int)
+    odds = np.repeat([[2.0, 3.0]], 100, axis=0)
+    cv = TimeSeriesSplit(2, 0.5)
+
+    # Output
+    results = apply_backtesting(bettor, param_grid, risk_factors, X, scores, odds, cv, 0, 3, 1)
+
+    # Expected output, test folds cover matches 50-74 and 75-99 with 8 and 9 home wins
+    home_params, no_bets_params = [str(params) for params in ParameterGrid(param_grid)]
+    mean_yield = (2.0 * 17 - 33) / 50
+    std_yield = np.sqrt((4.0 * 17 + 33) / 50 - mean_yield ** 2)
+    expected_results = pd.DataFrame([
+        [home_params, 0.0, 1.0, mean_yield, std_yield, 0.0],
+        [home_params, 1.0, 0.0, np.nan, np.nan, np.nan],
+        [no_bets_params, 0.0, 0.0, np.nan, np.nan, np.nan],
+        [no_bets_params, 1.0, 0.0, np.nan, np.nan, np.nan]
+    ], columns=['parameters', 'risk_factor', 'coverage', 'mean_yield', 'std_yield', 'std_mean_yield'])
+
+    sort_columns = ['parameters', 'risk_factor']
+    pd.testing.assert_frame_equal(
+        results.sort_values(sort_columns).reset_index(drop=True),
+        expected_results.sort_values(sort_columns).reset_index(drop=True)
+    )
+
+
+def test_apply_backtesting_deterministic(monkeypatch):
+    """Test backtesting with runs of deterministic bettors skipped."""
+
+    # Input data
+    random_state = np.random.RandomState(0)
+    bettor = Bettor(classifier=DummyClassifier(), targets=['D', 'H'])
+    param_grid = {'classifier__strategy': ['prior', 'stratified']}
+    X = random_state.random_sample((100, 2))
+    score1, score2 = random_state.randint(0, 3, 100), random_state.randint(0, 3, 100)
+    scores = score1, score2, score1, score2
+    odds = random_state.uniform(1.5, 3.0, (100, 2))
+    args = (bettor, param_grid, [0.0, 0.2], X, scores, odds, TimeSeriesSplit(2, 0.3), 0, 3, 1)
+
+    # Output with and without skipped runs
+    results = apply_backtesting(*args).sort_values(['parameters', 'risk_factor']).reset_index(drop=True)
+    monkeypatch.setattr('sportsbet.soccer.optimization.is_deterministic', lambda bettor: False)
+    expected_results = apply_backtesting(*args).sort_values(['parameters', 'risk_factor']).reset_index(drop=True)
+
+    prior_mask = results['parameters'] == str({'classifier__strategy': 'prior'})
+    assert prior_mask.sum() == 2
+    np.testing.assert_array_equal(results.loc[prior_mask, 'std_mean_yield'], 0.0)
+    pd.testing.assert_frame_equal(results, expected_results)
+
+
+@pytest.mark.parametrize('backend', ['loky', 'threading'])
+def test_apply_backtesting_threadpools(backend):
+    """Test that backtesting does not change the thread pools of the caller."""
+
+    # Input data
+    bettor = Bettor(classifier=DummyClassifier(), targets=['D', 'H'])
+    param_grid = {'classifier__strategy': ['uniform']}
+    X = np.random.random((100, 2))
+    scores = np.repeat([1, 0], 50), np.repeat([0, 1], 50), np.repeat([1, 0], 50), np.repeat([0, 1], 50)
+    odds = np.repeat([2.0, 2.0], 100).reshape(-1, 2)
+
+    # Thread pools before and after backtesting, BLAS uses more than one thread
+    with threadpool_limits(limits=2, user_api='blas'):
+        num_threads = {info['filepath']: info['num_threads'] for info in threadpool_info()}
+        apply_backtesting(bettor, param_grid, [0.0], X, scores, odds, TimeSeriesSplit(2, 0.3), 0, 2, 2, backend)
+        for info in threadpool_info():
+            if info['filepath'] in num_threads:
+                assert info['num_threads'] == num_threads[info['filepath']]
+
+
 def test_none_targets_bettor_mixin():
     """Test bettor mixin with none targets."""
     base_bettor = BettorMixin(None).fit()
@@ -137,6 +285,13 @@ def test_bettor_fit():
     np.testing.assert_array_equal(np.unique(bettor.classifier_.classes_), np.array(['A', 'over_2.5']))
 
 
+def test_bettor_fit_dataframe():
+    """Test fit method of bettor with non-numeric input data."""
+    X_df = pd.DataFrame({'feature': [0, 1, 2] * 10, 'team': ['x', 'y', 'z'] * 10})
+    bettor = Bettor(classifier=DummyClassifier(strategy='prior'), targets=['H', 'D']).fit(X_df, score1, score2, odds)
+    assert bettor.bet(X_df, 0.0).shape == (30,)
+
+
 def test_bettor_predict():
     """Test predict method of bettor."""
 
@@ -163,6 +318,18 @@ def test_bettor_predict_proba():
     assert bettor.predict_proba(X).shape == (30, 2)
 
 
+def test_bettor_bet():
+    """Test bet method of bettor."""
+
+    bettor = Bettor(classifier=DummyClassifier(strategy='prior'), targets=['H', 'D']).fit(X, score1, score2, odds)
+    np.testing.assert_array_equal(bettor.bet(X, 0.0), bettor.predict(X))
+    np.testing.assert_array_equal(bettor.bet(X, 0.9), np.repeat('-', len(X)))
+    for risk_factor, bets in zip([0.0, 0.9], bettor._bet_risk_factors(X, [0.0, 0.9])):
+        np.testing.assert_array_equal(bets, bettor.bet(X, risk_factor))
+    with pytest.raises(ValueError):
+        bettor.bet(X, 1.5)
+
+
 def test_multi_bettor_fit():
     """Test fit method of multi-bettor."""
     
@@ -179,6 +346,22 @@ def test_multi_bettor_fit():
     np.testing.assert_array_equal(np.unique(multi_bettor.meta_classifier_.classes_), np.array(['A', 'over_2.5']))
 
 
+def test_multi_bettor_fit_multi_classifier():
+    """Test that the multi-classifier of multi-bettor is fitted as a plain multi-output classifier."""
+
+    targets = ['H', 'over_2.5']
+    X_multi, _, score1_multi, _, score2_multi, _ = train_test_split(X, score1, score2, test_size=0.5, random_state=0)
+    multi_classifier = MultiOutputClassifier(LogisticRegression(), n_jobs=2).fit(X_multi, extract_multi_labels(score1_multi, score2_multi, targets))
+
+    multi_bettor = MultiBettor(multi_classifier=MultiOutputClassifier(LogisticRegression(), n_jobs=2), meta_classifier=DummyClassifier(), random_state=0, targets=targets).fit(X, score1, score2, odds)
+    for classes, expected_classes in zip(multi_bettor.multi_classifier_.classes_, multi_classifier.classes_):
+        np.testing.assert_array_equal(classes, expected_classes)
+    for estimator, expected_estimator in zip(multi_bettor.multi_classifier_.estimators_, multi_classifier.estimators_):
+        np.testing.assert_array_equal(estimator.coef_, expected_estimator.coef_)
+    for probs, expected_probs in zip(multi_bettor.multi_classifier_.predict_proba(X), multi_classifier.predict_proba(X)):
+        np.testing.assert_array_equal(probs, expected_probs)
+
+
 def test_multi_bettor_predict():
     """Test predict method of multi-bettor."""
     